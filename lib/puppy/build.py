@@ -19,7 +19,21 @@
 #  You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
-from panda3d.core import *
+import numpy
+from panda3d.core import BoundingBox, ColorAttrib, Geom, GeomLines, \
+                         GeomNode, GeomTriangles, GeomVertexArrayFormat, \
+                         GeomVertexData, GeomVertexFormat, GeomVertexWriter, \
+                         InternalName, LODNode, LPoint3f, LVecBase3f, \
+                         LVecBase4f, ModelNode, NodePath, RenderState, \
+                         Shader
+
+def _default_parent():
+    """Get the ShowBase render NodePath, or None if there is no ShowBase.
+    """
+    try:
+        return render
+    except NameError:
+        return None
 
 def _connect(object, indices, offset=0):
     """connect the vertices of a GeomPrimitive
@@ -28,6 +42,58 @@ def _connect(object, indices, offset=0):
         object.addVertex(index + offset)
     object.closePrimitive()
 
+def _readonly(array):
+    """Flag a NumPy array as read-only and return it.
+    """
+    array.flags.writeable = False
+    return array
+
+# Mapping of Panda3D numeric types to NumPy ones.
+_NUMERIC_TYPES = { Geom.NT_uint8 : numpy.uint8, Geom.NT_uint16 : numpy.uint16,
+  Geom.NT_uint32 : numpy.uint32, Geom.NT_float32 : numpy.float32 }
+
+def _fill(data, n, **columns):
+    """Fill the rows of a GeomVertexData from NumPy columns, in one copy.
+    """
+    format = data.getFormat().getArray(0)
+    buf = numpy.zeros((n, format.getStride()), dtype=numpy.uint8)
+    for name, values in columns.items():
+        column = format.getColumn(name)
+        dtype = _NUMERIC_TYPES[column.getNumericType()]
+        values = numpy.broadcast_to(numpy.asarray(values, dtype=numpy.float64),
+          (n, column.getNumComponents()))
+        if ((column.getContents() == Geom.C_color) and
+            (dtype == numpy.uint8)):
+            values = numpy.clip(values, 0., 1.) * 255.
+        values = numpy.ascontiguousarray(values, dtype=dtype)
+        start = column.getStart()
+        buf[:,start:(start + column.getTotalBytes())] = values.view(
+          numpy.uint8).reshape(n, -1)
+    data.modifyArray(0).modifyHandle().copyDataFrom(buf)
+
+def _primitive(cls, indices):
+    """Build a GeomPrimitive from a NumPy array of vertices indices.
+    """
+    primitive = cls(Geom.UHStatic)
+    # Note that 0xffff is reserved as strip cut index for 16-bit indices.
+    if indices.max() >= 0xffff:
+        primitive.setIndexType(Geom.NT_uint32)
+        dtype = numpy.uint32
+    else:
+        primitive.setIndexType(Geom.NT_uint16)
+        dtype = numpy.uint16
+    primitive.modifyVertices().modifyHandle().copyDataFrom(
+      numpy.ascontiguousarray(indices.ravel(), dtype=dtype))
+    return primitive
+
+def _cross(i, j):
+    """Vectorized version of cross, over the last axis."""
+    return numpy.cross(j, i)
+
+def _norm(v):
+    """Norm of vectors, over the last axis."""
+    return numpy.sqrt(numpy.sum(v * v, axis=-1))
+
 def multiply(s, v):
     """Multiply a vector with a scalar."""
     return (s * v[0], s * v[1], s * v[2])
@@ -59,18 +125,101 @@ class Builder:
         self.node = None
         self.path = None
 
-    def render(self):
+    def render(self, parent=None):
         """Render the GeomNode.
 
+        The GeomNode is attached to the provided parent NodePath, or to the
+        ShowBase render if none is given. Without any ShowBase, a standalone
+        NodePath is returned.
+
         Return: a NodePath to the rendered object.
         """
         if self.node is None:
             raise ValueError("empty GeomNode")
         if self.path is None:
-            self.path = render.attachNewNode(self.node)
+            if parent is None: parent = _default_parent()
+            if parent is None: self.path = NodePath(self.node)
+            else: self.path = parent.attachNewNode(self.node)
+        elif parent is not None:
+            self.path.reparentTo(parent)
         return self.path
 
-class PolyTube(Builder):
+def _transform(transform, vertices, faces):
+    """Apply a TransformState to vertices and faces arrays, possibly stacked.
+
+    Return: the transformed vertices and faces, as read-only arrays.
+    """
+    M = numpy.array(transform.getMat(), dtype=numpy.float64)
+    R, t = M[:3,:3], M[3,:3]
+    vertices = numpy.dot(vertices.reshape(-1, 3), R).reshape(
+      vertices.shape) + t
+    faces = numpy.dot(faces.reshape(-1, 3), R).reshape(faces.shape)
+    faces[...,0,:] += t
+    return _readonly(vertices), _readonly(faces)
+
+class Volume:
+    """Vertices and faces representation of a polyhedral volume.
+
+    The volume is attached to the Builder holding its geometry. Its vertices
+    and faces are given in world coordinates once the builder is rendered,
+    and in the builder's local frame otherwise.
+    """
+    def __init__(self, vertices, faces, builder):
+        self._vertices = _readonly(numpy.asarray(vertices,
+          dtype=numpy.float64))
+        self._faces = _readonly(numpy.asarray(faces, dtype=numpy.float64))
+        self._builder = builder
+        self._transform = None
+
+    def _update(self):
+        """Update the world representations if the NodePath, or any of its
+        ancestors, has moved.
+        """
+        transform = self._builder.path.getNetTransform()
+        if (self._transform is not None) and (transform == self._transform):
+            return
+        self._world_vertices, self._world_faces = _transform(transform,
+          self._vertices, self._faces)
+        self._transform = transform
+
+    def vertices(self):
+        """Return the vertices representation of the rendered object.
+
+        Return: a read-only (2 n, 3) array of the vertices coordinates.
+        """
+        if self._builder.path is None: return self._vertices
+        self._update()
+        return self._world_vertices
+
+    def faces(self):
+        """Return the faces representation of the rendered object.
+
+        Return: a read-only (n + 2, 2, 3) array of the faces (origin, normal)
+        pairs.
+        """
+        if self._builder.path is None: return self._faces
+        self._update()
+        return self._world_faces
+
+    def distance(self, point, direction=None, faces=None):
+        """Compute the signed distance of a point to the closest face.
+
+        The distance is negative if the point is outside of the volume.
+        """
+        if faces is None: faces = self.faces()
+        if direction is None:
+            # The face normals point outwards, thus a negative distance to a
+            # face means that the point is outside of it.
+            faces = numpy.asarray(faces, dtype=numpy.float64)
+            o, n = faces[:,0,:], faces[:,1,:]
+            d = numpy.sum(n * (o - numpy.asarray(point)), axis=1)
+            outside = d < 0.
+            if outside.any(): return float(d[outside].max())
+            else: return float(d.min())
+        else:
+            pass
+
+class PolyTube(Builder, Volume):
     """Builder for a tube with a polygonal section.
     """
     def __init__(self, *args, **kwargs):
@@ -140,15 +289,15 @@ class PolyTube(Builder):
         v2 = multiply(length, v2)
 
         # Build and export the vertices representation.
-        self._vertices = section + [[v[0] + v2[0], v[1] + v2[1], v[2] + v2[2]]
-                                    for v in section]
+        points = section + [[v[0] + v2[0], v[1] + v2[1], v[2] + v2[2]]
+                           for v in section]
 
         # Build and export the faces representation.
         n0 = cross(v0, v1)
         n0 = multiply(1. / dot(n0, n0)**0.5, n0)
         n1 = multiply(-1., n0)
         if dot(n, v2) < 0.: n0, n1 = n1, n0
-        self._faces = [(self._vertices[0], n0), (self._vertices[n_vx], n1)]
+        planes = [(points[0], n0), (points[n_vx], n1)]
         for i in xrange(n_vx):
             j = (i + 1) % n_vx
             k = (i + 2) % n_vx
@@ -158,7 +307,11 @@ class PolyTube(Builder):
             nrm = 1. / dot(n, n)**0.5
             if dot(n, r) > 0.: nrm = -nrm
             n = multiply(nrm, n)
-            self._faces.append((section[i], n))
+            planes.append((section[i], n))
+
+        # Store the representations as contiguous read-only arrays. The faces
+        # are packed as (origin, normal) pairs.
+        Volume.__init__(self, points, planes, self)
 
         if opts["face_color"] is not None:
             # Build the data vector for the faces.
@@ -276,47 +429,6 @@ class PolyTube(Builder):
             if self.node is None: self.node = GeomNode(opts["name"])
             self.node.addGeom(geom)
 
-    def vertices(self):
-        """Return the vertices representation of the rendered object.
-        """
-        if self.path is not None:
-            M = self.path.getMat()
-            vertices = [list(M.xformPoint(LVecBase3f(*v)))
-                        for v in self._vertices]
-        else:
-            vertices = self._vertices
-        return vertices
-
-    def faces(self):
-        """Return the faces representation of the rendered object.
-        """
-        if self.path is not None:
-            M = self.path.getMat()
-            faces = [[list(M.xformPoint(LVecBase3f(*v[0]))),
-                      list(M.xformVec(LVecBase3f(*v[1])))]
-                     for v in self._faces]
-        else:
-            faces = self._faces
-        return faces
-
-    def distance(self, point, direction=None, faces=None):
-        """Compute the signed distance of a point to the closest face.
-        """
-        if faces is None: faces = self.faces()
-        if direction is None:
-            dmin, dmax = None, None
-            for o, n in faces:
-                d = (n[0] * (o[0] - point[0]) + n[1] * (o[1] - point[1]) +
-                     n[2] * (o[2] - point[2]))
-                if d < 0.:
-                    if (dmax is None) or (d > dmax): dmax = d
-                else:
-                    if (dmin is None) or (d < dmin): dmin = d
-            if dmax is None: return dmin
-            else: return dmax
-        else:
-            pass
-
 class Box(PolyTube):
     """3D box builder from a generic polytube.
     """
@@ -331,39 +443,426 @@ class Box(PolyTube):
                    (0.5 * dx, 0.5 * dy), (0.5 * dx, -0.5 * dy))
         PolyTube.__init__(self, section, dz, **kwargs)
 
+class _TubeView(Volume):
+    """Read-only view of a single tube within a PolyTubes builder.
+    """
+    def __init__(self, builder, group, row):
+        self._builder = builder
+        self._group = group
+        self._row = row
+
+    def vertices(self):
+        return self._builder.vertices()[self._group][self._row]
+
+    def faces(self):
+        return self._builder.faces()[self._group][self._row]
+
+def _extrude(frames, lengths, sections, scale):
+    """Vectorized extrusion of m sections with n vertices each.
+
+    The frames are packed as (m, 4, 3) arrays of (origin, v0, v1, v2).
+    """
+    m, n = sections.shape[:2]
+    origin, v0, v1, v2 = [frames[:,i,:] for i in xrange(4)]
+    v2 = v2 * numpy.where(lengths < 0., -1., 1.)[:,None]
+    lengths = numpy.abs(lengths)
+
+    # Build the 3D sections.
+    section = (origin[:,None,:] + sections[:,:,0:1] * v0[:,None,:] +
+      sections[:,:,1:2] * v1[:,None,:] -
+      0.5 * (lengths[:,None] * v2)[:,None,:])
+
+    # Check the orientation of the sections.
+    u = _cross(section[:,1,:] - section[:,0,:], section[:,-1,:] -
+      section[:,0,:])
+    flip = numpy.sum(v2 * u, axis=1) < 0.
+    if flip.any():
+        order = (1 - numpy.arange(n)) % n
+        v0, v1 = (numpy.where(flip[:,None], v1, v0),
+                  numpy.where(flip[:,None], v0, v1))
+        sections = numpy.where(flip[:,None,None], sections[:,order,:],
+                               sections)
+        section = numpy.where(flip[:,None,None], section[:,order,:], section)
+    v2 = v2 * lengths[:,None]
+    top = section + v2[:,None,:]
+    next_section = numpy.roll(section, -1, axis=1)
+
+    # Build the vertices and faces representations.
+    vertices = numpy.concatenate((section, top), axis=1)
+    n0 = _cross(v0, v1)
+    n0 /= _norm(n0)[:,None]
+    swap = (numpy.sum(u * v2, axis=1) < 0.)[:,None]
+    n0, n1 = numpy.where(swap, -n0, n0), numpy.where(swap, n0, -n0)
+    u0 = next_section - section
+    r = numpy.roll(section, -2, axis=1) - section
+    normals = _cross(u0, v2[:,None,:])
+    nrm = 1. / _norm(normals)
+    nrm[numpy.sum(normals * r, axis=2) > 0.] *= -1.
+    normals *= nrm[:,:,None]
+    origins = numpy.concatenate((section[:,0:1,:], top[:,0:1,:], section),
+      axis=1)
+    normals = numpy.concatenate((n0[:,None,:], n1[:,None,:], normals), axis=1)
+    faces = numpy.stack((origins, normals), axis=2)
+
+    # Build the mesh positions.
+    bary = numpy.mean(section, axis=1)
+    sides = numpy.stack((section, next_section, numpy.roll(top, -1, axis=1),
+      top), axis=2).reshape(m, 4 * n, 3)
+    positions = numpy.concatenate((bary[:,None,:], section,
+      (bary + v2)[:,None,:], top, sides), axis=1)
+
+    # Build the texture coordinates.
+    o = sections[:,0,:]
+    cap = numpy.concatenate(((numpy.mean(sections, axis=1) - o)[:,None,:],
+      sections - o[:,None,:]), axis=1)
+    L0 = _norm(u0)
+    L12 = numpy.sum(v2 * v2, axis=1)
+    x1 = numpy.sum(u0 * v2[:,None,:], axis=2) / L0
+    y1 = numpy.sqrt(L12[:,None] - x1**2)
+    zero = numpy.zeros_like(L0)
+    sides = numpy.stack((numpy.stack((zero, zero), axis=2),
+      numpy.stack((L0, zero), axis=2), numpy.stack((L0 + x1, y1), axis=2),
+      numpy.stack((x1, y1), axis=2)), axis=2).reshape(m, 4 * n, 2)
+    texcoords = scale * numpy.concatenate((cap, cap, sides), axis=1)
+
+    return vertices, faces, positions, texcoords
+
+def _extrusion_indices(n):
+    """Triangles and lines indices of an extruded section with n vertices.
+    """
+    i = numpy.arange(n)
+    j = (i + 1) % n
+    zero = numpy.zeros(n, dtype=int)
+    caps = numpy.stack((numpy.stack((zero, i + 1, j + 1), axis=1),
+      numpy.stack((zero, j + 1, i + 1), axis=1) + n + 1), axis=1)
+    offset = (2 * n + 2 + 4 * i)[:,None]
+    sides = numpy.stack((numpy.array((2, 1, 0)) + offset,
+      numpy.array((3, 2, 0)) + offset), axis=1)
+    triangles = numpy.concatenate((caps.reshape(-1, 3), sides.reshape(-1, 3)))
+    lines = numpy.stack((numpy.stack((i, j), axis=1),
+      numpy.stack((i, j), axis=1) + n, numpy.stack((i, i + n), axis=1),
+      numpy.stack((j, j + n), axis=1)), axis=1).reshape(-1, 2)
+    return triangles, lines
+
+class PolyTubes(Builder):
+    """Bulk builder for many tubes with polygonal sections.
+
+    The sections are given either as a (m, n, 2) array, padded with NaN for
+    sections having less than n vertices, or as a sequence of m sections.
+    The frames are given as a (m, 4, 3) array of (origin, v0, v1, v2), or as
+    a single frame shared by all tubes, either (origin, v0, v1, v2) or
+    (origin, (v0, v1, v2)) as for PolyTube. The face color is either a
+    single color, a (m, 4) array of colors per tube, or a (m, n + 2, 4)
+    array of colors per face, ordered as for PolyTube. All tubes share the
+    same vertex buffers.
+
+    The vertices and faces representations are stacked by groups of tubes
+    having the same number of vertices. The tubes indices of each group are
+    given by the groups attribute. A Volume view of each tube is also
+    available from the volumes attribute.
+    """
+    def __init__(self, frames, sections, lengths, face_color=(1,1,1,1),
+      line_color=(0,0,0,1), texture_scale=None, name="polytubes"):
+        Builder.__init__(self)
+        self.name = name
+
+        # Unpack the sections and the number of vertices of each one.
+        if isinstance(sections, numpy.ndarray) and (sections.ndim == 3):
+            sections = numpy.asarray(sections, dtype=numpy.float64)
+            counts = numpy.sum(~numpy.isnan(sections[:,:,0]), axis=1)
+            padded = True
+        else:
+            counts = numpy.array([len(section) for section in sections],
+              dtype=int)
+            padded = False
+        m = len(counts)
+        if m == 0:
+            raise ValueError("empty sections")
+        if frames is None:
+            frames = ((0., 0., 0.), (1., 0., 0.), (0., 1., 0.), (0., 0., 1.))
+        elif ((len(frames) == 2) and (len(frames[0]) == 3) and
+              (len(frames[1]) == 3)):
+            # Single frame given as for a PolyTube.
+            origin, axes = frames
+            frames = (origin,) + tuple(axes)
+        frames = numpy.broadcast_to(numpy.asarray(frames,
+          dtype=numpy.float64), (m, 4, 3))
+        lengths = numpy.broadcast_to(numpy.asarray(lengths,
+          dtype=numpy.float64), (m,))
+        if texture_scale is None: texture_scale = 1.
+        if face_color is not None:
+            face_color = numpy.asarray(face_color, dtype=numpy.float64)
+            if face_color.shape in ((4,), (m, 4)):
+                face_color = numpy.broadcast_to(face_color.reshape(-1, 1, 4),
+                  (m, 1, 4))
+            elif ((face_color.ndim != 3) or (face_color.shape[0] != m) or
+                  (face_color.shape[1] < counts.max() + 2) or
+                  (face_color.shape[2] != 4)):
+                raise ValueError("Invalid face color")
+
+        # Offsets of each tube in the shared vertex and index buffers.
+        n_rows = 6 * counts + 2
+        rows = numpy.cumsum(n_rows) - n_rows
+        n_lines = 2 * counts
+        lines_rows = numpy.cumsum(n_lines) - n_lines
+        n_indices = 4 * counts
+        indices = numpy.cumsum(n_indices) - n_indices
+
+        # Extrude the sections, grouped by number of vertices.
+        positions = numpy.empty((n_rows.sum(), 3))
+        texcoords = numpy.empty((n_rows.sum(), 2))
+        colors = numpy.empty((n_rows.sum(), 4))
+        lines_positions = numpy.empty((n_lines.sum(), 3))
+        triangles = numpy.empty((n_indices.sum(), 3), dtype=numpy.int64)
+        lines = numpy.empty((n_indices.sum(), 2), dtype=numpy.int64)
+        groups, vertices, faces = [], [], []
+        volumes = [None] * m
+        for n in numpy.unique(counts):
+            if n < 3:
+                raise ValueError("Invalid section")
+            index = numpy.nonzero(counts == n)[0]
+            if padded:
+                group = sections[index,:n,:]
+            else:
+                group = numpy.array([sections[k] for k in index],
+                  dtype=numpy.float64)
+            v, f, p, t = _extrude(frames[index], lengths[index], group,
+              texture_scale)
+            for row, k in enumerate(index):
+                volumes[k] = _TubeView(self, len(groups), row)
+            groups.append(index)
+            vertices.append(_readonly(v))
+            faces.append(_readonly(f))
+
+            # Scatter the group data to the shared buffers.
+            r = (rows[index][:,None] + numpy.arange(6 * n + 2)).ravel()
+            positions[r] = p.reshape(-1, 3)
+            texcoords[r] = t.reshape(-1, 2)
+            if face_color is not None:
+                if face_color.shape[1] == 1:
+                    face_index = numpy.zeros(6 * n + 2, dtype=int)
+                else:
+                    face_index = numpy.concatenate((
+                      numpy.zeros(n + 1, dtype=int),
+                      numpy.ones(n + 1, dtype=int),
+                      numpy.repeat(numpy.arange(2, n + 2), 4)))
+                colors[r] = face_color[index][:,face_index,:].reshape(
+                  -1, 4)
+            r = (lines_rows[index][:,None] + numpy.arange(2 * n)).ravel()
+            lines_positions[r] = v.reshape(-1, 3)
+            t, l = _extrusion_indices(n)
+            r = (indices[index][:,None] + numpy.arange(4 * n)).ravel()
+            triangles[r] = (t[None,:,:] +
+              rows[index][:,None,None]).reshape(-1, 3)
+            lines[r] = (l[None,:,:] +
+              lines_rows[index][:,None,None]).reshape(-1, 2)
+        self.groups = tuple(groups)
+        self.volumes = volumes
+        self._vertices = tuple(vertices)
+        self._faces = tuple(faces)
+        self._transform = None
+
+        if face_color is not None:
+            # Build the Geom for the faces and initialise the node.
+            format = GeomVertexFormat.getV3c4t2()
+            data = GeomVertexData("vertices", format, Geom.UHStatic)
+            _fill(data, len(positions), vertex=positions, color=colors,
+              texcoord=texcoords)
+            faces = Geom(data)
+            faces.addPrimitive(_primitive(GeomTriangles, triangles))
+            if self.node is None: self.node = GeomNode(name)
+            self.node.addGeom(faces)
+
+        if line_color is not None:
+            # Build the Geom for the borders and add it to the node.
+            format = GeomVertexFormat.getV3c4()
+            data = GeomVertexData("vertices", format, Geom.UHStatic)
+            _fill(data, len(lines_positions), vertex=lines_positions,
+              color=line_color)
+            geom = Geom(data)
+            geom.addPrimitive(_primitive(GeomLines, lines))
+            if self.node is None: self.node = GeomNode(name)
+            self.node.addGeom(geom)
+
+    def _update(self):
+        """Update the world representations if the NodePath, or any of its
+        ancestors, has moved.
+        """
+        transform = self.path.getNetTransform()
+        if (self._transform is not None) and (transform == self._transform):
+            return
+        world = [_transform(transform, v, f)
+                 for v, f in zip(self._vertices, self._faces)]
+        self._world_vertices = tuple(v for v, _ in world)
+        self._world_faces = tuple(f for _, f in world)
+        self._transform = transform
+
+    def vertices(self):
+        """Return the vertices representation of the rendered tubes.
+
+        Return: a tuple of read-only (m, 2 n, 3) arrays of the vertices
+        coordinates, one per group of tubes.
+        """
+        if self.path is None: return self._vertices
+        self._update()
+        return self._world_vertices
+
+    def faces(self):
+        """Return the faces representation of the rendered tubes.
+
+        Return: a tuple of read-only (m, n + 2, 2, 3) arrays of the faces
+        (origin, normal) pairs, one per group of tubes.
+        """
+        if self.path is None: return self._faces
+        self._update()
+        return self._world_faces
+
+# GLSL shader decoding the quantized vertices of a compact Map.
+_MAP_VERTEX_SHADER = """#version 150
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_TextureMatrix[1];
+uniform vec3 quantization_scale;
+uniform vec3 quantization_offset;
+in vec4 p3d_Vertex;
+in vec4 p3d_Color;
+out vec2 texcoord;
+out vec4 color;
+
+void main() {
+    vec3 position = quantization_offset + quantization_scale * p3d_Vertex.xyz;
+    gl_Position = p3d_ModelViewProjectionMatrix * vec4(position, 1.);
+    texcoord = (p3d_TextureMatrix[0] * vec4(position.xy, 0., 1.)).xy;
+    color = p3d_Color;
+}
+"""
+
+_MAP_FRAGMENT_SHADER = """#version 150
+uniform sampler2D p3d_Texture0;
+uniform vec4 p3d_ColorScale;
+in vec2 texcoord;
+in vec4 color;
+out vec4 p3d_FragColor;
+
+void main() {
+    p3d_FragColor = texture(p3d_Texture0, texcoord) * color * p3d_ColorScale;
+}
+"""
+
+# The shader and the vertex format are instanciated on first use.
+_map_shader = None
+_map_format = None
+
+def _get_map_shader():
+    """Get the shader decoding compact Map vertices.
+    """
+    global _map_shader
+    if _map_shader is None:
+        _map_shader = Shader.make(Shader.SL_GLSL, _MAP_VERTEX_SHADER,
+          _MAP_FRAGMENT_SHADER)
+    return _map_shader
+
+def _get_map_format():
+    """Get the compact Map vertex format: RGBA8 colors and 16-bit positions.
+    """
+    global _map_format
+    if _map_format is None:
+        array = GeomVertexArrayFormat()
+        array.addColumn(InternalName.getColor(), 4, Geom.NT_uint8,
+          Geom.C_color)
+        array.addColumn(InternalName.getVertex(), 3, Geom.NT_uint16,
+          Geom.C_point)
+        _map_format = GeomVertexFormat.registerFormat(array)
+    return _map_format
+
+def _quantize(values):
+    """Quantize coordinates to 16-bit integers.
+
+    Regularly spaced coordinates are mapped to their indices, exactly.
+    Others are scaled over the full 16-bit range.
+
+    Return: the quantized values, the scale and the offset.
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    vmin, vmax = values.min(), values.max()
+    if values.ndim == 1:
+        if len(values) > 0x10000:
+            raise ValueError("too many grid nodes")
+        if len(values) == 1:
+            return numpy.zeros(1), 1., vmin
+        step = (values[-1] - values[0]) / (len(values) - 1)
+        if numpy.allclose(numpy.diff(values), step):
+            return numpy.arange(len(values), dtype=numpy.float64), step, \
+              values[0]
+    if vmax == vmin: return numpy.zeros(values.shape), 1., vmin
+    scale = (vmax - vmin) / 0xffff
+    return numpy.round((values - vmin) / scale), scale, vmin
+
 class Map(Builder):
     """3D map builder from Panda primitives.
+
+    With the compact option, faces and lines share a single data vector with
+    16-bit quantized positions and RGBA8 colors. The vertices are decoded by
+    a shader, using the quantization scale and offset of the map. Note that
+    the texture coordinates are then derived from the x and y coordinates,
+    which is only compatible with single texture stages. The GeomNode is
+    held by a ModelNode preserving it from flattening, since flattening
+    would bake transforms into the 16-bit positions. Note also that only the
+    bounds account for the quantization. CPU side users of the vertices,
+    e.g. collisions and picking, would see the quantized coordinates.
     """
     def __init__(self, x, y, z, face_color=(1,1,1,1), line_color=(0,0,0,1),
-      name="map"):
+      name="map", compact=False):
         Builder.__init__(self)
         self.name = name
         nx, ny = len(x), len(y)
         n = nx * ny
 
-        if face_color is not None:
-            # Build the data vector for the faces.
-            format = GeomVertexFormat.getV3c4t2()
-            data = GeomVertexData("vertices", format, Geom.UHStatic)
-            data.setNumRows(n)
-            writer = GeomVertexWriter(data, "vertex")
-            for i, yi in enumerate(y):
-                for j, xj in enumerate(x):
-                    writer.addData3f(xj, yi, z[i,j])
-            writer = GeomVertexWriter(data, "color")
-            try:
-                if len(face_color[0]) != nx:
-                    raise ValueError("Invalid face colors")
-            except TypeError:
-                for _ in xrange(n): writer.addData4f(face_color)
+        if compact:
+            # Build a quantized data vector, shared by the faces and lines.
+            qx, sx, ox = _quantize(x)
+            qy, sy, oy = _quantize(y)
+            qz, sz, oz = _quantize(z)
+            positions = numpy.empty((ny, nx, 3))
+            positions[:,:,0] = qx[None,:]
+            positions[:,:,1] = qy[:,None]
+            positions[:,:,2] = qz
+            if face_color is None:
+                colors = (1., 1., 1., 1.)
             else:
+                colors = numpy.asarray(face_color, dtype=numpy.float64)
+                if colors.shape not in ((4,), (ny, nx, 4)):
+                    raise ValueError("Invalid face colors")
+                colors = colors.reshape(-1, 4)
+            data = GeomVertexData("vertices", _get_map_format(), Geom.UHStatic)
+            _fill(data, n, vertex=positions.reshape(-1, 3), color=colors)
+            z = numpy.asarray(z)
+            bounds = BoundingBox(LPoint3f(min(x), min(y), z.min()),
+                                 LPoint3f(max(x), max(y), z.max()))
+
+        if face_color is not None:
+            if not compact:
+                # Build the data vector for the faces.
+                format = GeomVertexFormat.getV3c4t2()
+                data = GeomVertexData("vertices", format, Geom.UHStatic)
+                data.setNumRows(n)
+                writer = GeomVertexWriter(data, "vertex")
+                for i, yi in enumerate(y):
+                    for j, xj in enumerate(x):
+                        writer.addData3f(xj, yi, z[i,j])
+                writer = GeomVertexWriter(data, "color")
+                try:
+                    if len(face_color[0]) != nx:
+                        raise ValueError("Invalid face colors")
+                except TypeError:
+                    for _ in xrange(n): writer.addData4f(face_color)
+                else:
+                    for i in xrange(ny):
+                        for j in xrange(nx):
+                            writer.addData4f(face_color[i][j])
+                writer = GeomVertexWriter(data, "texcoord")
                 for i in xrange(ny):
                     for j in xrange(nx):
-                        writer.addData4f(face_color[i][j])
-            writer = GeomVertexWriter(data, "texcoord")
-            for i in xrange(ny):
-                for j in xrange(nx):
-                    writer.addData2f(x[j], y[i])
+                        writer.addData2f(x[j], y[i])
 
             # Build the triangles.
             triangles = GeomTriangles(Geom.UHStatic)
@@ -386,20 +885,22 @@ class Map(Builder):
             # Build the Geom for the faces and initialise the node.
             geom = Geom(data)
             geom.addPrimitive(triangles)
+            if compact: geom.setBounds(bounds)
             if self.node is None: self.node = GeomNode(name)
             self.node.addGeom(geom)
 
         if line_color is not None:
-            # Build the data vector for the lines.
-            format = GeomVertexFormat.getV3c4()
-            data = GeomVertexData("vertices", format, Geom.UHStatic)
-            data.setNumRows(n)
-            writer = GeomVertexWriter(data, "vertex")
-            for i, yi in enumerate(y):
-                for j, xj in enumerate(x):
-                    writer.addData3f(xj, yi, z[i,j])
-            writer = GeomVertexWriter(data, "color")
-            for _ in xrange(n): writer.addData4f(line_color)
+            if not compact:
+                # Build the data vector for the lines.
+                format = GeomVertexFormat.getV3c4()
+                data = GeomVertexData("vertices", format, Geom.UHStatic)
+                data.setNumRows(n)
+                writer = GeomVertexWriter(data, "vertex")
+                for i, yi in enumerate(y):
+                    for j, xj in enumerate(x):
+                        writer.addData3f(xj, yi, z[i,j])
+                writer = GeomVertexWriter(data, "color")
+                for _ in xrange(n): writer.addData4f(line_color)
 
             # Build the lines.
             lines = GeomLines(Geom.UHStatic)
@@ -413,19 +914,39 @@ class Map(Builder):
             # Build the Geom for lines and add it to the node.
             geom = Geom(data)
             geom.addPrimitive(lines)
+            if compact:
+                geom.setBounds(bounds)
+                state = RenderState.make(ColorAttrib.makeFlat(
+                  LVecBase4f(*line_color)))
+            else:
+                state = RenderState.makeEmpty()
             if self.node is None: self.node = GeomNode(name)
-            self.node.addGeom(geom)
+            self.node.addGeom(geom, state)
+
+        if compact and (self.node is not None):
+            # Attach the decoding shader and the quantization parameters.
+            path = NodePath(self.node)
+            path.setShader(_get_map_shader())
+            path.setShaderInput("quantization_scale", LVecBase3f(sx, sy, sz))
+            path.setShaderInput("quantization_offset", LVecBase3f(ox, oy, oz))
+
+            # Protect the quantized vertices from any flattening.
+            root = ModelNode(name)
+            root.setPreserveTransform(ModelNode.PT_no_touch)
+            root.addChild(self.node)
+            self.node = root
 
 class Terrain(Builder):
     """3D terrain builder from maps, implementing a level of details.
     """
     def __init__(self, x, y, z, face_color=(1,1,1,1), line_color=(0,0,0,1),
-      name="terrain", lod=3, dlim=50.):
+      name="terrain", lod=3, dlim=50., parent=None, compact=False):
         Builder.__init__(self)
         self.name = name
         self.node = True
         self.path = NodePath("Terrain")
-        self.path.reparentTo(render)
+        if parent is None: parent = _default_parent()
+        if parent is not None: self.path.reparentTo(parent)
 
         size = 2**lod - 2**(lod - 1) + 1
         nx, ny = (len(x) - 1) / (size - 1), (len(y) - 1) / (size - 1)
@@ -441,14 +962,13 @@ class Terrain(Builder):
                 path.reparentTo(self.path)
                 d = 0.
                 for i in xrange(lod):
-                    p = Map(x2[::2**i], y2[::2**i], z2[::2**i,::2**i],
-                      face_color, line_color, name).render()
+                    Map(x2[::2**i], y2[::2**i], z2[::2**i,::2**i],
+                      face_color, line_color, name, compact).render(path)
                     if i == 0: di = dlim
                     elif i == lod - 1: di = 1E+12
                     else: di = 2 * d
                     ln.addSwitch(di, d)
                     d = di
-                    p.reparentTo(path)
                 xoff += size - 1
             yoff += size - 1
 
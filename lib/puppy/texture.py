@@ -20,7 +20,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 # Panda3D modules.
-from direct.showbase.Loader import Loader
 from panda3d.core import SamplerState, Texture, TextureStage
 
 # Global rendering options.
@@ -28,8 +27,25 @@ ANISOTROPIC_FILTERING = 4
 MIPMAP = True
 MIRROR = True
 
-# Instanciate a Panda3D loader.
-loader = Loader(None)
+# The Panda3D loader is instanciated on first use.
+_loader = None
+
+def get_loader():
+    """Get the Panda3D loader, instanciating it if needed.
+    """
+    global _loader
+    if _loader is None:
+        from direct.showbase.Loader import Loader
+        _loader = Loader(None)
+    return _loader
+
+class _LazyLoader:
+    """Proxy to the Panda3D loader, instanciated on first access.
+    """
+    def __getattr__(self, name):
+        return getattr(get_loader(), name)
+
+loader = _LazyLoader()
 
 def load(path, anisotropic=None, mipmap=None, mirror=None):
     """Load a texture and apply some rendering properties.
@@ -38,7 +54,7 @@ def load(path, anisotropic=None, mipmap=None, mirror=None):
     if mipmap is None: mipmap = MIPMAP
     if mirror is None: mirror = MIRROR
 
-    texture = loader.loadTexture(path)
+    texture = get_loader().loadTexture(path)
     texture.setAnisotropicDegree(anisotropic)
     if mipmap:
         texture.setMagfilter(SamplerState.FT_linear_mipmap_linear)
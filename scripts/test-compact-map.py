@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+import numpy
+import puppy.build
+import puppy.control
+from panda3d.core import GeomVertexReader, NodePath, TextureStage
+
+def decode(path):
+    """Decode the world positions of a compact map."""
+    geom_path = path.find("**/+GeomNode")
+    data = geom_path.node().getGeom(0).getVertexData()
+    reader = GeomVertexReader(data, "vertex")
+    quantized = []
+    while not reader.isAtEnd():
+        quantized.append(tuple(reader.getData3()))
+    scale = geom_path.getShaderInput("quantization_scale").getVector()
+    offset = geom_path.getShaderInput("quantization_offset").getVector()
+    M = numpy.array(geom_path.getNetTransform().getMat())
+    positions = (numpy.array(offset)[:3] +
+                 numpy.array(scale)[:3] * numpy.array(quantized))
+    return numpy.dot(positions, M[:3,:3]) + M[3,:3]
+
+class Test(puppy.control.KeyboardCamera):
+    def __init__(self):
+        puppy.control.KeyboardCamera.__init__(self)
+
+        # Create a compact map, under a transformed parent.
+        x = numpy.linspace(-10., 10., 201)
+        y = numpy.linspace(-10., 10., 201)
+        z = 2. * numpy.outer(numpy.sin(0.5 * y), numpy.cos(0.5 * x))
+        self.root = NodePath("root")
+        self.root.reparentTo(self.render)
+        parent = self.root.attachNewNode("parent")
+        parent.setPos(0., 0., -2.)
+        parent.setScale(1.5)
+        self.map = puppy.build.Map(x, y, z, line_color=None,
+          compact=True).render(parent)
+        texture = loader.loadTexture("maps/envir-ground.jpg")
+        self.map.setTexture(texture)
+        self.map.setTexScale(TextureStage.getDefault(), 0.2)
+
+        # Check that flattening leaves the decoded positions unchanged.
+        positions = decode(self.root)
+        self.root.flattenStrong()
+        if not numpy.allclose(positions, decode(self.root), atol=1E-04):
+            raise RuntimeError("compact map altered by flattening")
+
+        # Initialise the camera.
+        self.camera.setPos(25., -25., 15.)
+        self.camera.lookAt(self.map)
+
+Test().run()
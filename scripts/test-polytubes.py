@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+import numpy
+import puppy.build
+import puppy.control
+
+class Test(puppy.control.KeyboardCamera):
+    def __init__(self):
+        puppy.control.KeyboardCamera.__init__(self)
+
+        # Grab some default texture.
+        texture = loader.loadTexture("maps/envir-reeds.png")
+
+        # Create a grid of prisms, alternating triangular and square sections.
+        n = 20
+        sections = numpy.full((n * n, 4, 2), numpy.nan)
+        sections[0::2,:3,:] = ((-0.4, -0.4), (0.4, -0.4), (0., 0.4))
+        sections[1::2,:,:] = ((-0.4, -0.4), (0.4, -0.4), (0.4, 0.4),
+                              (-0.4, 0.4))
+        frames = numpy.zeros((n * n, 4, 3))
+        frames[:,1:,:] = numpy.eye(3)
+        frames[:,0,0] = numpy.repeat(numpy.arange(n), n)
+        frames[:,0,1] = numpy.tile(numpy.arange(n), n)
+        lengths = numpy.random.uniform(0.5, 3., n * n)
+        frames[:,0,2] = 0.5 * lengths
+
+        # Colorise each face of the prisms.
+        colors = numpy.random.uniform(0.5, 1., (n * n, 6, 4))
+        colors[:,:,3] = 1.
+
+        self.prisms = puppy.build.PolyTubes(frames, sections, lengths,
+          face_color=colors)
+        self.path = self.prisms.render()
+        self.path.setTexture(texture)
+
+        # Print the distance of the grid center to the prisms.
+        center = (0.5 * n, 0.5 * n, 1.)
+        d = [volume.distance(center) for volume in self.prisms.volumes]
+        print("signed distance to the closest prism: {:.3f}".format(max(d)))
+
+        # Initialise the camera.
+        self.camera.setPos(-10., -10., 15.)
+        self.camera.lookAt(self.path, 0.5 * n, 0.5 * n, 0.)
+
+Test().run()